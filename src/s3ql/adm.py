@@ -510,6 +510,14 @@ def upgrade(options, on_return):
              mock.patch.object(metadata, 'DUMP_SPEC', OLD_DUMP_SPEC):
             db = metadata.download_metadata(backend, cachepath + '.db')
 
+    # The upgrade copies every row of the objects and inode_blocks tables, so
+    # give sqlite enough memory to keep the working set out of the disk.
+    # Journaling and syncing are already disabled by initsql. We deliberately
+    # keep temp_store = FILE, since VACUUM would otherwise have to hold a
+    # complete copy of the database in memory.
+    db.execute('PRAGMA cache_size = -65536')
+    db.execute('PRAGMA mmap_size = 10737418240')
+
     log.info('Upgrading from revision %d to %d...', param['revision'], CURRENT_FS_REV)
 
     param['revision'] = CURRENT_FS_REV
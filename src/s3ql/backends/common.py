@@ -9,6 +9,7 @@ This work can be distributed under the terms of the GNU GPLv3.
 from ..logging import logging, QuietError, LOG_ONCE # Ensure use of custom logger class
 from abc import abstractmethod, ABCMeta
 from functools import wraps
+from dugong import is_temp_network_error
 import time
 import textwrap
 import hashlib
@@ -72,13 +73,44 @@ class RateTracker:
         return sum(self.buckets)
 
 
+class RecoveryNotifier:
+    '''
+    Allow threads that are waiting to retry a request that failed because of
+    a network problem to be woken up as soon as some other request succeeds,
+    since this indicates that the network has recovered.
+    '''
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.waiters = 0
+
+    def wait(self, timeout):
+        '''Wait for *timeout* seconds or until `notify` is called'''
+
+        with self.cond:
+            self.waiters += 1
+            try:
+                self.cond.wait(timeout)
+            finally:
+                self.waiters -= 1
+
+    def notify(self):
+        '''Wake up all waiting threads'''
+
+        # Reading without lock is fine, in the worst case a thread that just
+        # started to wait will wait for its full timeout.
+        if self.waiters:
+            with self.cond:
+                self.cond.notify_all()
+
+
 # We maintain a (global) running average of temporary errors, so
 # that we can log a warning if this number becomes large. We
 # use a relatively large window to prevent bogus spikes if
 # multiple threads all have to retry after a long period of
 # inactivity.
 RETRY_TIMEOUT = 60 * 60 * 24
-def retry(method, _tracker=RateTracker(60)):
+def retry(method, _tracker=RateTracker(60), _recovery=RecoveryNotifier()):
     '''Wrap *method* for retrying on some exceptions
 
     If *method* raises an exception for which the instance's
@@ -87,6 +119,11 @@ def retry(method, _tracker=RateTracker(60)):
     seconds, the most-recently caught exception is re-raised. If the
     method defines a keyword parameter *is_retry*, then this parameter
     will be set to True whenever the function is retried.
+
+    If *method* failed because of a connection-level problem (e.g. a timeout
+    or a dropped connection), a pending retry is performed early when any
+    other wrapped method call succeeds. Errors returned by the server (e.g.
+    asking us to slow down) always wait for the full interval.
     '''
 
     if inspect.isgeneratorfunction(method):
@@ -99,13 +136,16 @@ def retry(method, _tracker=RateTracker(60)):
     def wrapped(*a, **kw):
         self = a[0]
         interval = 1 / 50
-        waited = 0
+        # Measure actual elapsed time, this includes the time spent in
+        # *method* itself (e.g. waiting for network timeouts), the random
+        # variation of the interval and early wake-ups.
+        deadline = time.monotonic() + RETRY_TIMEOUT
         retries = 0
         while True:
             if has_is_retry:
                 kw['is_retry'] = (retries > 0)
             try:
-                return method(*a, **kw)
+                res = method(*a, **kw)
             except Exception as exc:
                 # Access to protected member ok
                 #pylint: disable=W0212
@@ -121,7 +161,7 @@ def retry(method, _tracker=RateTracker(60)):
                 else:
                     log.debug('Average retry rate: %.2f Hz', rate)
 
-                if waited > RETRY_TIMEOUT:
+                if time.monotonic() > deadline:
                     log.error('%s.%s(*): Timeout exceeded, re-raising %r exception',
                             self.__class__.__name__, method.__name__, exc)
                     raise
@@ -141,11 +181,21 @@ def retry(method, _tracker=RateTracker(60)):
                 if hasattr(exc, 'retry_after') and exc.retry_after:
                     log.debug('retry_after is %.2f seconds', exc.retry_after)
                     interval = exc.retry_after
+                    wake_early = False
+                else:
+                    # Only network problems are likely to be resolved when
+                    # other requests succeed again.
+                    wake_early = is_temp_network_error(exc)
+            else:
+                _recovery.notify()
+                return res
 
             # Add some random variation to prevent flooding the
             # server with too many concurrent requests.
-            time.sleep(interval * random.uniform(1, 1.5))
-            waited += interval
+            if wake_early:
+                _recovery.wait(interval * random.uniform(1, 1.5))
+            else:
+                time.sleep(interval * random.uniform(1, 1.5))
             interval = min(5*60, 2*interval)
 
     extend_docstring(wrapped,
@@ -27,6 +27,9 @@ log = logging.getLogger(__name__)
 
 HMAC_SIZE = 32
 
+# Header of every packet in an encrypted stream (length of the packet data)
+PACKET_HEADER = struct.Struct(b'<I')
+
 crypto_backend = crypto_backends.default_backend()
 
 def sha256(s):
@@ -500,7 +503,7 @@ class EncryptFilter(object):
         if len(data) == 0:
             return
 
-        buf = struct.pack(b'<I', len(data)) + data
+        buf = PACKET_HEADER.pack(len(data)) + data
         self.hmac.update(buf)
         buf2 = self.encryptor.update(buf)
         assert len(buf2) == len(buf)
@@ -513,7 +516,7 @@ class EncryptFilter(object):
         # up.
         if not self.closed:
             # Packet length of 0 indicates end of stream, only HMAC follows
-            buf = struct.pack(b'<I', 0)
+            buf = PACKET_HEADER.pack(0)
             self.hmac.update(buf)
             buf += self.hmac.digest()
             buf2 = self.encryptor.update(buf)
@@ -544,7 +547,7 @@ class DecryptFilter(InputFilter):
     checking to work.
     '''
 
-    off_size = struct.calcsize(b'<I')
+    off_size = PACKET_HEADER.size
 
     def __init__(self, fh, key, metadata=None):
         '''Initialize
@@ -622,7 +625,7 @@ class DecryptFilter(InputFilter):
             # from next packet
             outbuf += inbuf[:self.remaining]
             self.hmac.update(inbuf[:to_next])
-            paket_size = struct.unpack(b'<I', inbuf[self.remaining:to_next])[0]
+            paket_size = PACKET_HEADER.unpack(inbuf[self.remaining:to_next])[0]
             inbuf = inbuf[to_next:]
             self.remaining = paket_size
 
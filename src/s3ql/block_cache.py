@@ -16,6 +16,7 @@ from queue import Queue, Empty as QueueEmpty, Full as QueueFull
 from argparse import Namespace
 import os
 import hashlib
+import itertools
 import shutil
 import threading
 import time
@@ -31,6 +32,21 @@ except ModuleNotFoundError:
 # standard logger for this module
 log = logging.getLogger(__name__)
 
+# Cache entries that have been accessed at least this many times are
+# considered hot and are only expired after all other entries...
+HOT_HITS = 3
+
+# ...unless they take up more than this fraction of the cache
+HOT_FRACTION = 0.1
+
+# Accesses within this many seconds of the last counted hit (e.g. reading a
+# block in several chunks, or the first read of a prefetched block) do not
+# count as another hit
+HOT_INTERVAL = 1
+
+# Every this many seconds without a hit, an entry loses one hit
+HOT_DECAY = 60
+
 # Special queue entry that signals threads to terminate
 QuitSentinel = object()
 
@@ -55,10 +71,13 @@ class CacheEntry(object):
     :dirty:    entry has been changed since it was last uploaded.
     :size:     current file size
     :pos: current position in file
+    :hits: number of times the entry was retrieved from the cache
+    :last_hit: time (from time.monotonic()) of the last counted hit, or
+               of the creation of the entry
     """
 
     __slots__ = [ 'dirty', 'inode', 'blockno', 'last_write',
-                  'size', 'pos', 'fh', 'removed' ]
+                  'size', 'pos', 'fh', 'removed', 'hits', 'last_hit' ]
 
     def __init__(self, inode, blockno, filename, mode='w+b'):
         super().__init__()
@@ -70,9 +89,24 @@ class CacheEntry(object):
         self.inode = inode
         self.blockno = blockno
         self.last_write = 0
+        self.hits = 0
+        self.last_hit = time.monotonic()
         self.pos = self.fh.tell()
         self.size = os.fstat(self.fh.fileno()).st_size
 
+    def get_hits(self, now):
+        '''Return number of hits, taking into account decay'''
+
+        return max(0, self.hits - int((now - self.last_hit) // HOT_DECAY))
+
+    def hit(self):
+        '''Register a retrieval of the entry from the cache'''
+
+        now = time.monotonic()
+        if now - self.last_hit >= HOT_INTERVAL:
+            self.hits = self.get_hits(now) + 1
+            self.last_hit = now
+
     def read(self, size=None):
         buf = self.fh.read(size)
         self.pos += len(buf)
@@ -115,6 +149,29 @@ class CacheEntry(object):
                 % ('Dirty ' if self.dirty else '', self.inode, self.blockno))
 
 
+class Download:
+    '''
+    A download of a backend object that is in progress.
+
+    Attributes:
+
+    :obj_id: id of the object that is being downloaded
+    :path: temporary file that the object is being downloaded into
+    :done: event that is set when the download has finished
+    :success: True if the download completed successfully
+    :users: number of tasks that still need the downloaded data
+    '''
+
+    __slots__ = [ 'obj_id', 'path', 'done', 'success', 'users' ]
+
+    def __init__(self, obj_id, path):
+        self.obj_id = obj_id
+        self.path = path
+        self.done = trio.Event()
+        self.success = False
+        self.users = 1
+
+
 class CacheDict(OrderedDict):
     '''
     An ordered dictionary designed to store CacheEntries.
@@ -165,6 +222,14 @@ class BlockCache(object):
     :removal_threads: list of threads processing removal queue
     :db: Handle to SQL DB
     :backend_pool: BackendPool instance
+    :prefetch_nursery: nursery used to run background downloads. If None,
+                       prefetching is disabled.
+    :prefetching: set of (inode, blockno) tuples that are currently being
+                  prefetched
+    :prefetch_completed: signals completion of a background download
+    :downloads: dict mapping object ids to `Download` instances for objects
+                that are being downloaded, or whose downloaded data is still
+                being copied into cache entries
     """
 
     def __init__(self, backend_pool, db, cachedir, max_size, max_entries=768):
@@ -179,10 +244,14 @@ class BlockCache(object):
         self.upload_threads = []
         self.removal_threads = []
         self.transfer_completed = trio.Condition()
+        self.prefetching = set()
+        self.prefetch_completed = trio.Condition()
+        self.downloads = dict()
 
         # Will be initialized once threads are available
         self.to_upload = None
         self.to_remove = None
+        self.prefetch_nursery = None
 
         if os.path.exists(self.path):
             self.load_cache()
@@ -213,10 +282,15 @@ class BlockCache(object):
         '''Get number of objects in cache'''
         return len(self.cache)
 
-    def init(self, threads=1):
-        '''Start worker threads'''
+    def init(self, threads=1, nursery=None):
+        '''Start worker threads
+
+        If *nursery* is given, it is used to run background downloads
+        requested with `prefetch`.
+        '''
 
         self.trio_token = trio.lowlevel.current_trio_token()
+        self.prefetch_nursery = nursery
         self.to_upload = trio.open_memory_channel(0)
         for _ in range(threads):
             t = threading.Thread(target=self._upload_loop)
@@ -242,6 +316,13 @@ class BlockCache(object):
     async def destroy(self, keep_cache=False):
         '''Clean up and stop worker threads'''
 
+        # Prevent new prefetches, and wait for the running ones so that
+        # they do not add entries while the cache is being flushed.
+        self.prefetch_nursery = None
+        async with self.prefetch_completed:
+            while self.prefetching:
+                await self.prefetch_completed.wait()
+
         log.debug('Flushing cache...')
         try:
             if keep_cache:
@@ -459,14 +540,14 @@ class BlockCache(object):
         obj_lock_taken = False
         try:
             try:
-                old_obj_id = self.db.get_val('SELECT obj_id FROM inode_blocks '
-                                             'WHERE inode=? AND blockno=?',
-                                             (el.inode, el.blockno))
+                old_obj_id = self.db.get_first_val('SELECT obj_id FROM inode_blocks '
+                                                   'WHERE inode=? AND blockno=?',
+                                                   (el.inode, el.blockno))
             except NoSuchRowError:
                 old_obj_id = None
 
             try:
-                obj_id = self.db.get_val('SELECT id FROM objects WHERE hash=?', (hash_,))
+                obj_id = self.db.get_first_val('SELECT id FROM objects WHERE hash=?', (hash_,))
 
             # No object with same hash
             except NoSuchRowError:
@@ -477,8 +558,7 @@ class BlockCache(object):
                 # Note: we must finish all db transactions before adding to
                 # in_transit, otherwise commit() may return before all blocks
                 # are available in db.
-                self.db.execute('INSERT OR REPLACE INTO inode_blocks (obj_id, inode, blockno) '
-                                'VALUES(?,?,?)', (obj_id, el.inode, el.blockno))
+                self._link_block(el, obj_id, old_obj_id)
 
                 await self.mlock.acquire(obj_id)
                 obj_lock_taken = True
@@ -490,8 +570,7 @@ class BlockCache(object):
                     log.debug('(re)linking to %d', obj_id)
                     self.db.execute('UPDATE objects SET refcount=refcount+1 WHERE id=?',
                                     (obj_id,))
-                    self.db.execute('INSERT OR REPLACE INTO inode_blocks (obj_id, inode, blockno) '
-                                    'VALUES(?,?,?)', (obj_id, el.inode, el.blockno))
+                    self._link_block(el, obj_id, old_obj_id)
 
                 el.dirty = False
                 self.in_transit.remove(el)
@@ -516,6 +595,22 @@ class BlockCache(object):
         return obj_lock_taken
 
 
+    def _link_block(self, el, obj_id, old_obj_id):
+        '''Make the block of cache entry *el* refer to *obj_id*
+
+        *old_obj_id* is the object that the block currently refers to, or
+        None. Since we know whether the block is already in the database, we
+        can update the row in place instead of using INSERT OR REPLACE (which
+        deletes the old row and inserts a new one).
+        '''
+
+        if old_obj_id is None:
+            self.db.execute('INSERT INTO inode_blocks (obj_id, inode, blockno) '
+                            'VALUES(?,?,?)', (obj_id, el.inode, el.blockno))
+        else:
+            self.db.execute('UPDATE inode_blocks SET obj_id=? WHERE inode=? AND blockno=?',
+                            (obj_id, el.inode, el.blockno))
+
     async def _queue_upload(self, obj):
         '''Put *obj* into upload queue'''
 
@@ -552,8 +647,8 @@ class BlockCache(object):
         If reference counter drops to zero, remove object.
         '''
 
-        (refcount, size) = self.db.get_row('SELECT refcount, phys_size FROM objects WHERE id=?',
-                                           (obj_id,))
+        (refcount, size) = self.db.get_first_row('SELECT refcount, phys_size FROM objects '
+                                                 'WHERE id=?', (obj_id,))
         if refcount > 1:
             log.debug('decreased refcount for object: %d', obj_id)
             self.db.execute('UPDATE objects SET refcount=refcount-1 WHERE id=?', (obj_id,))
@@ -676,8 +771,8 @@ class BlockCache(object):
         except KeyError:
             filename = os.path.join(self.path, '%d-%d' % (inode, blockno))
             try:
-                obj_id = self.db.get_val('SELECT obj_id FROM inode_blocks '
-                                         'WHERE inode=? AND blockno=?', (inode, blockno))
+                obj_id = self.db.get_first_val('SELECT obj_id FROM inode_blocks '
+                                               'WHERE inode=? AND blockno=?', (inode, blockno))
 
             # No corresponding object
             except NoSuchRowError:
@@ -686,37 +781,7 @@ class BlockCache(object):
                 self.cache[(inode, blockno)] = el
                 return el
 
-            # Need to download corresponding object
-            log.debug('downloading object %d..', obj_id)
-            tmpfh = open(filename + '.tmp', 'wb')
-            try:
-                def do_read(fh):
-                    tmpfh.seek(0)
-                    tmpfh.truncate()
-                    shutil.copyfileobj(fh, tmpfh, BUFSIZE)
-
-                # Lock object. This ensures that we wait until the object
-                # is uploaded. We don't have to worry about deletion, because
-                # as long as the current cache entry exists, there will always be
-                # a reference to the object (and we already have a lock on the
-                # cache entry).
-                await self.mlock.acquire(obj_id)
-                await self.mlock.release(obj_id)
-
-                def with_lock_released():
-                    with self.backend_pool() as backend:
-                        backend.perform_read(do_read, 's3ql_data_%d' % obj_id)
-                await trio.to_thread.run_sync(with_lock_released)
-
-                tmpfh.flush()
-                os.fsync(tmpfh.fileno())
-                os.rename(tmpfh.name, filename)
-            except:
-                os.unlink(tmpfh.name)
-                raise
-            finally:
-                tmpfh.close()
-
+            await self._download(obj_id, filename)
             el = CacheEntry(inode, blockno, filename, mode='r+b')
             self.cache[(inode, blockno)] = el
             self.cache.size += el.size
@@ -724,10 +789,169 @@ class BlockCache(object):
         # In Cache
         else:
             #log.debug('in cache')
+            el.hit()
             self.cache.move_to_end((inode, blockno), last=True) # move to head
 
         return el
 
+    async def _download(self, obj_id, filename):
+        '''Download object *obj_id* into *filename*
+
+        Several blocks may refer to the same object (after deduplication or
+        s3qlcp). If the object is already being downloaded for another cache
+        entry, wait for that download and copy the result instead of sending
+        another request to the backend.
+        '''
+
+        while True:
+            dl = self.downloads.get(obj_id, None)
+            if dl is None:
+                break
+            dl.users += 1
+            try:
+                await dl.done.wait()
+            except:
+                self._release_download(dl)
+                raise
+            if dl.success:
+                await self._claim_download(dl, filename)
+                return
+            # Download failed, try ourselves
+            dl.users -= 1
+
+        dl = Download(obj_id, os.path.join(self.path, 'obj-%d.download' % obj_id))
+        self.downloads[obj_id] = dl
+        try:
+            await self._fetch(obj_id, dl.path)
+            dl.success = True
+        finally:
+            dl.done.set()
+            if not dl.success:
+                del self.downloads[obj_id]
+                dl.users -= 1
+        await self._claim_download(dl, filename)
+
+    async def _claim_download(self, dl, filename):
+        '''Store result of successful download *dl* in *filename*
+
+        The last user of a download takes over the downloaded file, all
+        others copy it. Until then, the download stays in `downloads` so
+        that no new download of the same object overwrites the file.
+        '''
+
+        if dl.users == 1:
+            dl.users = 0
+            del self.downloads[dl.obj_id]
+            os.rename(dl.path, filename)
+            return
+
+        def do_copy():
+            log.debug('copying %s to %s', dl.path, filename)
+            with open(dl.path, 'rb') as src, open(filename + '.tmp', 'wb') as dst:
+                shutil.copyfileobj(src, dst, BUFSIZE)
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.rename(filename + '.tmp', filename)
+
+        try:
+            await trio.to_thread.run_sync(do_copy)
+        finally:
+            self._release_download(dl)
+
+    def _release_download(self, dl):
+        '''Release *dl*, remove downloaded file if no longer needed'''
+
+        dl.users -= 1
+        if dl.users == 0 and dl.success:
+            del self.downloads[dl.obj_id]
+            os.unlink(dl.path)
+
+    async def _fetch(self, obj_id, path):
+        '''Download object *obj_id* from the backend into *path*'''
+
+        log.debug('downloading object %d..', obj_id)
+        tmpfh = open(path, 'wb')
+        try:
+            def do_read(fh):
+                tmpfh.seek(0)
+                tmpfh.truncate()
+                shutil.copyfileobj(fh, tmpfh, BUFSIZE)
+
+            # Lock object. This ensures that we wait until the object
+            # is uploaded. We don't have to worry about deletion, because
+            # as long as the current cache entry exists, there will always be
+            # a reference to the object (and we already have a lock on the
+            # cache entry).
+            await self.mlock.acquire(obj_id)
+            await self.mlock.release(obj_id)
+
+            def with_lock_released():
+                with self.backend_pool() as backend:
+                    backend.perform_read(do_read, 's3ql_data_%d' % obj_id)
+            await trio.to_thread.run_sync(with_lock_released)
+
+            tmpfh.flush()
+            os.fsync(tmpfh.fileno())
+        except:
+            os.unlink(tmpfh.name)
+            raise
+        finally:
+            tmpfh.close()
+
+    def prefetch(self, inode, blocknos):
+        '''Start background download of *blocknos* of *inode*
+
+        Blocks that are already cached, currently locked or being prefetched
+        are skipped. No new downloads are started once the cache (including
+        the downloads that are still running) has reached its size or entry
+        limit. Since the size of a block is only known once it has been
+        downloaded, running prefetches may still push the cache over its size
+        limit, in which case the next call to `get` expires entries as usual.
+        '''
+
+        if self.prefetch_nursery is None:
+            return
+
+        for blockno in blocknos:
+            if (self.cache.size >= self.cache.max_size
+                or len(self.cache) + len(self.prefetching) >= self.cache.max_entries):
+                break
+            key = (inode, blockno)
+            if key in self.cache or key in self.prefetching:
+                continue
+            log.debug('prefetching block %d of inode %d', blockno, inode)
+            self.prefetching.add(key)
+            self.prefetch_nursery.start_soon(self._prefetch, inode, blockno)
+
+    async def _prefetch(self, inode, blockno):
+        '''Download `blockno` of `inode` into the cache'''
+
+        try:
+            # Don't wait for blocks that are in use, they will already be in
+            # the cache when we get the lock. Note that we can't use
+            # mlock.acquire_nowait() here, because that also fails if another
+            # task is just holding the condition lock of the MultiLock.
+            if (inode, blockno) in self.mlock.locked_keys:
+                return
+            await self.mlock.acquire(inode, blockno)
+            try:
+                if ((inode, blockno) not in self.cache
+                    and self.db.has_val('SELECT 1 FROM inode_blocks WHERE inode=? AND blockno=?',
+                                        (inode, blockno))):
+                    await self._get_entry(inode, blockno)
+            finally:
+                await self.mlock.release(inode, blockno)
+
+        # Nobody asked for this data, so no error must take down the file
+        # system. Errors will be reported if the block is actually read.
+        except Exception as exc:
+            log.debug('prefetching block %d of inode %d failed: %s', blockno, inode, exc)
+
+        finally:
+            self.prefetching.discard((inode, blockno))
+            async with self.prefetch_completed:
+                self.prefetch_completed.notify_all()
+
     async def expire(self):
         """Perform cache expiry."""
 
@@ -743,17 +967,52 @@ class BlockCache(object):
             if need_size <= 0 and need_entries <= 0:
                 break
 
-            # Need to make copy, since we aren't allowed to change dict while
-            # iterating through it. Look at the comments in CommitThread.run()
-            # (mount.py) for an estimate of the resulting performance hit.
-            sth_in_transit = False
-            for el in list(self.cache.values()):
+            # The cache is ordered from least to most recently used, so the
+            # entries to evict are at the front. Collect just as many as we
+            # need (we aren't allowed to change the dict while iterating
+            # through it), rather than copying the entire cache. Hot entries
+            # are skipped, so that a large sequential read does not push out
+            # frequently used blocks, but only up to a fraction of the cache.
+            # If that is not sufficient, hot entries are expired as well.
+            # Always allow at least one hot entry, so that small caches
+            # benefit as well. If there are more hot entries than that, the
+            # most recently used ones are protected.
+            protect_size = self.cache.max_size * HOT_FRACTION
+            if self.cache.max_entries > 0:
+                protect_entries = max(1, int(self.cache.max_entries * HOT_FRACTION))
+            else:
+                protect_entries = 0
+            now = time.monotonic()
+            protected = set()
+            for el in reversed(self.cache.values()):
+                if protect_entries < 1:
+                    break
+                if el.get_hits(now) >= HOT_HITS and el.size <= protect_size:
+                    protect_size -= el.size
+                    protect_entries -= 1
+                    protected.add((el.inode, el.blockno))
+
+            to_expire = []
+            hot = []
+            for el in self.cache.values():
                 if need_size <= 0 and need_entries <= 0:
                     break
-
+                if (el.inode, el.blockno) in protected:
+                    hot.append(el)
+                    continue
                 need_entries -= 1
                 need_size -= el.size
+                to_expire.append(el)
+            else:
+                for el in hot:
+                    if need_size <= 0 and need_entries <= 0:
+                        break
+                    need_entries -= 1
+                    need_size -= el.size
+                    to_expire.append(el)
 
+            sth_in_transit = False
+            for el in to_expire:
                 if await self.upload_if_dirty(el):
                     sth_in_transit = True
                     continue
@@ -791,7 +1050,20 @@ class BlockCache(object):
 
         if end_no is None:
             end_no = start_no + 1
-        blocknos = set(range(start_no, end_no))
+
+        if end_no - start_no == 1:
+            blocknos = { start_no }
+        else:
+            # Files may be sparse, so rather than looking at every block
+            # number in the range only consider blocks that are stored in
+            # the database, cached, or currently locked (and thus possibly
+            # about to be added to the cache).
+            blocknos = set(blockno for (blockno,) in self.db.query(
+                'SELECT blockno FROM inode_blocks WHERE inode=? AND blockno >= ? '
+                'AND blockno < ?', (inode, start_no, end_no)))
+            for key in itertools.chain(self.cache.keys(), self.mlock.locked_keys):
+                if len(key) == 2 and key[0] == inode and start_no <= key[1] < end_no:
+                    blocknos.add(key[1])
 
         # First do an opportunistic pass and remove everything where we can
         # immediately get a lock. This is important when removing a file right
@@ -812,8 +1084,8 @@ class BlockCache(object):
                         self.cache.remove((inode, blockno))
 
                     try:
-                        obj_id = self.db.get_val('SELECT obj_id FROM inode_blocks '
-                                                 'WHERE inode=? AND blockno=?', (inode, blockno))
+                        obj_id = self.db.get_first_val('SELECT obj_id FROM inode_blocks '
+                                                       'WHERE inode=? AND blockno=?', (inode, blockno))
                     except NoSuchRowError:
                         log.debug('block not in db')
                         continue
@@ -857,8 +1129,49 @@ class BlockCache(object):
             to_flush = [ x for x in self.cache.values()
                          if x.inode == inode ]
 
-        for el in to_flush:
-            await self.upload_if_dirty(el)
+        await self._upload_many(to_flush)
+
+    async def _upload_many(self, els):
+        '''Call `upload_if_dirty` for all *els*
+
+        Cache entries are processed concurrently, with as many entries at a
+        time as there are upload threads, so that checksums are calculated
+        while earlier entries are being uploaded.
+
+        Return True if any entry is scheduled for upload. If processing an
+        entry raises an exception, no further entries are started and the
+        first exception is re-raised once all running ones have finished.
+        '''
+
+        limiter = trio.CapacityLimiter(max(1, len(self.upload_threads or ())))
+        sth_in_transit = False
+        failure = None
+
+        async def upload(el):
+            nonlocal sth_in_transit, failure
+            # Do not cancel the remaining entries if one of them fails,
+            # upload_if_dirty() must not be interrupted once it has
+            # added an object to the database.
+            with trio.CancelScope(shield=True):
+                async with limiter:
+                    if failure is not None:
+                        return
+                    try:
+                        if await self.upload_if_dirty(el):
+                            sth_in_transit = True
+                    except Exception as exc:
+                        if failure is None:
+                            failure = exc
+
+        async with trio.open_nursery() as nursery:
+            for el in els:
+                if el.dirty or el in self.in_transit:
+                    nursery.start_soon(upload, el)
+
+        if failure is not None:
+            raise failure
+
+        return sth_in_transit
 
     async def flush(self):
         """Upload all dirty blocks."""
@@ -866,14 +1179,10 @@ class BlockCache(object):
         log.debug('started')
 
         while True:
-            sth_in_transit = False
-
             # Need to make copy, since dict() may change while uploading.  Look
             # at the comments in CommitTask.run() (mount.py) for an estimate of
             # the performance impact.
-            for el in list(self.cache.values()):
-                if await self.upload_if_dirty(el):
-                    sth_in_transit = True
+            sth_in_transit = await self._upload_many(list(self.cache.values()))
 
             if not sth_in_transit:
                 break
@@ -7,7 +7,7 @@ This work can be distributed under the terms of the GNU GPLv3.
 '''
 
 from .logging import logging, QuietError # Ensure use of custom logger class
-from . import BUFSIZE, CTRL_NAME, ROOT_INODE
+from . import BUFSIZE, CTRL_NAME, CTRL_INODE, ROOT_INODE
 from dugong import HostnameNotResolvable
 from getpass import getpass
 from ast import literal_eval
@@ -21,7 +21,6 @@ import time
 import subprocess
 import errno
 import hashlib
-import pyfuse3
 import posixpath
 import functools
 import contextlib
@@ -193,9 +192,15 @@ def assert_s3ql_fs(path):
             raise QuietError('File system appears to have crashed.')
         raise
 
+    # The control file is not included in directory listings, but it can be
+    # looked up directly and always has the same inode number. Checking this
+    # is much cheaper than reading the entire directory.
     ctrlfile = os.path.join(path, CTRL_NAME)
-    if not (CTRL_NAME not in pyfuse3.listdir(path)
-            and os.path.exists(ctrlfile)):
+    try:
+        ctrl_ino = os.stat(ctrlfile).st_ino
+    except OSError:
+        ctrl_ino = None
+    if ctrl_ino != CTRL_INODE:
         raise QuietError('%s is not on an S3QL file system' % path)
 
     return ctrlfile
@@ -11,6 +11,8 @@ Module Attributes:
 
 :initsql:      SQL commands that are executed whenever a new
                connection is created.
+:STATEMENT_CACHE_SIZE: Number of prepared statements that are kept
+               around by every connection.
 '''
 
 from .logging import logging, QuietError # Ensure use of custom logger class
@@ -44,6 +46,14 @@ initsql = (
            'PRAGMA legacy_file_format = off',
            )
 
+# APSW keeps an LRU cache of prepared statements (keyed by the SQL text) for
+# every connection, so executing a constant SQL string only has to bind
+# parameters rather than re-parse and re-plan the query. The default of 100
+# statements is less than the number of distinct statements issued by the
+# file system operations, block cache and fsck together, and cache misses
+# would therefore be frequent.
+STATEMENT_CACHE_SIZE = 256
+
 class Connection(object):
     '''
     This class wraps an APSW connection object. It should be used instead of any
@@ -62,7 +72,7 @@ class Connection(object):
     '''
 
     def __init__(self, file_):
-        self.conn = apsw.Connection(file_)
+        self.conn = apsw.Connection(file_, statementcachesize=STATEMENT_CACHE_SIZE)
         self.file = file_
 
         cur = self.conn.cursor()
@@ -110,6 +120,11 @@ class Connection(object):
         self.conn.cursor().execute(*a, **kw)
         return self.changes()
 
+    def executemany(self, *a, **kw):
+        '''Execute the given SQL statement for each parameter sequence'''
+
+        self.conn.cursor().executemany(*a, **kw)
+
     def rowid(self, *a, **kw):
         """Execute SQL statement and return last inserted rowid"""
 
@@ -167,6 +182,32 @@ class Connection(object):
 
         return row
 
+    def get_first_val(self, *a, **kw):
+        """Execute statement and return first element of first result row.
+
+        Like `get_val`, but does not check for further result rows. Use this
+        for lookups on unique keys, where this check would only cost an
+        extra step of the SQL statement.
+        """
+
+        return self.get_first_row(*a, **kw)[0]
+
+    def get_first_row(self, *a, **kw):
+        """Execute select statement and return first row.
+
+        If there are no result rows, raises `NoSuchRowError`. Further result
+        rows are ignored.
+        """
+
+        res = self.conn.cursor().execute(*a, **kw)
+        try:
+            return next(res)
+        except StopIteration:
+            raise NoSuchRowError()
+        finally:
+            # Finish the active SQL statement
+            res.close()
+
     def last_rowid(self):
         """Return rowid most recently inserted in the current thread"""
 
@@ -16,7 +16,6 @@ import collections
 import errno
 import pyfuse3
 from pyfuse3 import FUSEError
-import math
 import os
 import stat
 import struct
@@ -33,6 +32,16 @@ log = logging.getLogger(__name__)
 # this interval.
 CHECKPOINT_INTERVAL = 0.05
 
+# Used to pad data read from holes and short blocks, so that we don't have to
+# allocate a fresh zero-filled buffer for every read. Slicing the memoryview does
+# not copy. This is larger than the maximum FUSE read size.
+ZEROES = memoryview(bytes(1024 * 1024))
+
+# Number of consecutive sequential reads after which we start to
+# prefetch blocks, and number of blocks to prefetch.
+SEQUENTIAL_READ_THRESHOLD = 2
+PREFETCH_BLOCKS = 4
+
 # ACL_ERRNO is the error code returned for requests that try
 # to modify or access extendeda attributes associated with ACL.
 # Since we currently don't know how to keep these in sync
@@ -98,6 +107,9 @@ class Operations(pyfuse3.Operations):
                     attempts to retrieve them. This attribute is a dict (indexed by inodes)
                     of sets of block indices. Broken blocks are removed from the cache
                     when an inode is forgotten.
+    :read_state: Used to detect sequential reads. This attribute is a dict (indexed by
+                 inodes) of (next offset, number of sequential reads, last block for
+                 which prefetching was requested) tuples.
 
     Directory Entry Types
     ----------------------
@@ -125,10 +137,50 @@ class Operations(pyfuse3.Operations):
         self.cache = block_cache
         self.failsafe = False
         self.broken_blocks = collections.defaultdict(set)
+        self.read_state = dict()
 
         # Root inode is always open
         self.open_inodes[pyfuse3.ROOT_INODE] += 1
 
+        self._init_stats()
+
+    def _init_stats(self):
+        '''Set up temporary table with object and inode statistics
+
+        statfs() is called frequently, so rather than aggregating over the
+        objects and inodes tables on every call we maintain the totals with
+        triggers. The table and triggers are temporary and thus not part of
+        the metadata.
+        '''
+
+        self.db.execute('DROP TABLE IF EXISTS temp.fs_stats')
+        self.db.execute('CREATE TEMP TABLE fs_stats (objects INT, inodes INT, length INT)')
+        self.db.execute('INSERT INTO fs_stats (objects, inodes, length) '
+                        'SELECT (SELECT COUNT(id) FROM objects), (SELECT COUNT(id) FROM inodes), '
+                        '(SELECT IFNULL(SUM(length), 0) FROM objects)')
+        self.db.execute('CREATE TEMP TRIGGER IF NOT EXISTS fs_stats_objects_insert '
+                        'AFTER INSERT ON objects BEGIN '
+                        'UPDATE fs_stats SET objects=objects+1, length=length+new.length; END')
+        self.db.execute('CREATE TEMP TRIGGER IF NOT EXISTS fs_stats_objects_delete '
+                        'AFTER DELETE ON objects BEGIN '
+                        'UPDATE fs_stats SET objects=objects-1, length=length-old.length; END')
+        self.db.execute('CREATE TEMP TRIGGER IF NOT EXISTS fs_stats_objects_update '
+                        'AFTER UPDATE OF length ON objects BEGIN '
+                        'UPDATE fs_stats SET length=length-old.length+new.length; END')
+        self.db.execute('CREATE TEMP TRIGGER IF NOT EXISTS fs_stats_inodes_insert '
+                        'AFTER INSERT ON inodes BEGIN '
+                        'UPDATE fs_stats SET inodes=inodes+1; END')
+        self.db.execute('CREATE TEMP TRIGGER IF NOT EXISTS fs_stats_inodes_delete '
+                        'AFTER DELETE ON inodes BEGIN '
+                        'UPDATE fs_stats SET inodes=inodes-1; END')
+
+    def _block_count(self, size):
+        '''Return number of blocks needed to store *size* bytes'''
+
+        # Avoid float division, it is slower and loses precision
+        # for large sizes.
+        return (size + self.max_obj_size - 1) // self.max_obj_size
+
     async def destroy(self):
         await self.forget(list(self.open_inodes.items()))
         self.inodes.destroy()
@@ -506,10 +558,11 @@ class Operations(pyfuse3.Operations):
                         processed += db.execute('INSERT INTO inode_blocks (inode, blockno, obj_id) '
                                                 'SELECT ?, blockno, obj_id FROM inode_blocks '
                                                 'WHERE inode=?', (id_new, id_))
-                        db.execute('REPLACE INTO objects (id, hash, refcount, phys_size, length) '
-                                   'SELECT id, hash, refcount+COUNT(id), phys_size, length '
-                                   'FROM inode_blocks JOIN objects ON obj_id = id '
-                                   'WHERE inode = ? GROUP BY id', (id_new,))
+                        # Don't use REPLACE, the implicit delete would not fire
+                        # the triggers that maintain fs_stats
+                        refs = db.get_list('SELECT COUNT(obj_id), obj_id FROM inode_blocks '
+                                           'WHERE inode=? GROUP BY obj_id', (id_new,))
+                        db.executemany('UPDATE objects SET refcount=refcount+? WHERE id=?', refs)
 
                         if db.has_val('SELECT 1 FROM contents WHERE parent_inode=?', (id_,)):
                             queue.append((id_, id_new, -1))
@@ -603,7 +656,7 @@ class Operations(pyfuse3.Operations):
 
         if inode.refcount == 0 and id_ not in self.open_inodes:
             log.debug('removing from cache')
-            await self.cache.remove(id_, 0, int(math.ceil(inode.size / self.max_obj_size)))
+            await self.cache.remove(id_, 0, self._block_count(inode.size))
             # Since the inode is not open, it's not possible that new blocks
             # get created at this point and we can safely delete the inode
             self.db.execute('UPDATE names SET refcount = refcount - 1 WHERE '
@@ -668,8 +721,8 @@ class Operations(pyfuse3.Operations):
             target_exists = True
 
         if target_exists:
-            self._replace(id_p_old, name_old, id_p_new, name_new,
-                          inode_old.id, inode_new.id)
+            await self._replace(id_p_old, name_old, id_p_new, name_new,
+                                inode_old.id, inode_new.id)
             await self.forget([(inode_old.id, 1), (inode_new.id, 1)])
         else:
             self._rename(id_p_old, name_old, id_p_new, name_new)
@@ -724,8 +777,8 @@ class Operations(pyfuse3.Operations):
         inode_p_new.mtime_ns = now_ns
         inode_p_new.ctime_ns = now_ns
 
-    def _replace(self, id_p_old, name_old, id_p_new, name_new,
-                 id_old, id_new):
+    async def _replace(self, id_p_old, name_old, id_p_new, name_new,
+                       id_old, id_new):
 
         now_ns = time_ns()
 
@@ -757,8 +810,7 @@ class Operations(pyfuse3.Operations):
         inode_p_new.mtime_ns = now_ns
 
         if inode_new.refcount == 0 and id_new not in self.open_inodes:
-            self.cache.remove(id_new, 0,
-                              int(math.ceil(inode_new.size / self.max_obj_size)))
+            await self.cache.remove(id_new, 0, self._block_count(inode_new.size))
             # Since the inode is not open, it's not possible that new blocks
             # get created at this point and we can safely delete the inode
             self.db.execute('UPDATE names SET refcount = refcount - 1 WHERE '
@@ -834,9 +886,8 @@ class Operations(pyfuse3.Operations):
             len_ = attr.st_size
 
             # Determine blocks to delete
-            last_block = len_ // self.max_obj_size
-            cutoff = len_ % self.max_obj_size
-            total_blocks = int(math.ceil(inode.size / self.max_obj_size))
+            (last_block, cutoff) = divmod(len_, self.max_obj_size)
+            total_blocks = self._block_count(inode.size)
 
             # Adjust file size
             inode.size = len_
@@ -889,10 +940,9 @@ class Operations(pyfuse3.Operations):
         self.inodes.flush()
 
         entries = self.db.get_val("SELECT COUNT(rowid) FROM contents")
-        objects = self.db.get_val("SELECT COUNT(id) FROM objects")
-        inodes = self.db.get_val("SELECT COUNT(id) FROM inodes")
+        (objects, inodes, dedup_size) = self.db.get_row(
+            'SELECT objects, inodes, length FROM fs_stats')
         fs_size = self.db.get_val('SELECT SUM(size) FROM inodes') or 0
-        dedup_size = self.db.get_val('SELECT SUM(length) FROM objects') or 0
 
         # Objects that are currently being uploaded/compressed have size == -1
         compr_size = self.db.get_val('SELECT SUM(phys_size) FROM objects '
@@ -906,12 +956,8 @@ class Operations(pyfuse3.Operations):
 
         stat_ = pyfuse3.StatvfsData()
 
-        objects = self.db.get_val("SELECT COUNT(id) FROM objects")
-        inodes = self.db.get_val("SELECT COUNT(id) FROM inodes")
-        size = self.db.get_val('SELECT SUM(length) FROM objects')
-
-        if size is None:
-            size = 0
+        (objects, inodes, size) = self.db.get_row(
+            'SELECT objects, inodes, length FROM fs_stats')
 
         # file system block size, i.e. the minimum amount of space that can
         # be allocated. This doesn't make much sense for S3QL, so we just
@@ -1044,21 +1090,55 @@ class Operations(pyfuse3.Operations):
         size = inode.size
         length = min(size - offset, length)
 
+        start = offset
         while length > 0:
             tmp = await self._readwrite(fh, offset, length=length)
             buf.write(tmp)
             length -= len(tmp)
             offset += len(tmp)
 
+        if offset > start:
+            self._readahead(fh, start, offset, size)
+
         # Inode may have expired from cache
         inode = self.inodes[fh]
 
+        # Like relatime, only update atime if it is older than mtime or
+        # ctime. This only changes the cached inode, the database is updated
+        # when the inode is flushed or expires from the inode cache. Reads
+        # therefore do not write to the database.
         if inode.atime_ns < inode.ctime_ns or inode.atime_ns < inode.mtime_ns:
             inode.atime_ns = time_ns()
 
         return buf.getvalue()
 
 
+    def _readahead(self, id_, start, end, size):
+        '''Prefetch blocks if *id_* is being read sequentially
+
+        *start* and *end* are the offsets of the current read, *size* is the
+        size of the file.
+        '''
+
+        (next_offset, seq_reads, prefetched) = self.read_state.get(id_, (None, 0, None))
+        if start == next_offset:
+            seq_reads += 1
+        else:
+            # Random access, stop prefetching
+            seq_reads = 0
+            prefetched = None
+
+        # Only request each window once, rather than on every (possibly
+        # very small) read request.
+        blockno = (end - 1) // self.max_obj_size
+        if seq_reads >= SEQUENTIAL_READ_THRESHOLD and blockno != prefetched:
+            last_block = (size - 1) // self.max_obj_size
+            self.cache.prefetch(id_, range(blockno + 1,
+                                           min(blockno + PREFETCH_BLOCKS, last_block) + 1))
+            prefetched = blockno
+
+        self.read_state[id_] = (end, seq_reads, prefetched)
+
     async def write(self, fh, offset, buf):
         '''Handle FUSE write requests.'''
 
@@ -1074,13 +1154,16 @@ class Operations(pyfuse3.Operations):
             offset += written
             buf = buf[written:]
 
-        # Update file size if changed
-        # Fuse does not ensure that we do not get concurrent write requests,
-        # so we have to be careful not to undo a size extension made by
-        # a concurrent write.
+        # Update file size if changed. The current size is kept in the inode
+        # cache, so this does not require a database query. Fuse does not
+        # ensure that we do not get concurrent write requests, so we have to
+        # be careful not to undo a size extension made by a concurrent write.
+        # The inode may have been evicted from the cache while we were
+        # writing, so we have to look it up again.
         now_ns = time_ns()
         inode = self.inodes[fh]
-        inode.size = max(inode.size, minsize)
+        if minsize > inode.size:
+            inode.size = minsize
         inode.mtime_ns = now_ns
         inode.ctime_ns = now_ns
 
@@ -1098,8 +1181,7 @@ class Operations(pyfuse3.Operations):
         """
 
         # Calculate required block
-        blockno = offset // self.max_obj_size
-        offset_rel = offset - blockno * self.max_obj_size
+        (blockno, offset_rel) = divmod(offset, self.max_obj_size)
 
         if id_ in self.broken_blocks and blockno in self.broken_blocks[id_]:
             raise FUSEError(errno.EIO)
@@ -1144,7 +1226,10 @@ class Operations(pyfuse3.Operations):
             return buf
         else:
             # If we can't read enough, add null bytes
-            return buf + b"\0" * (length - len(buf))
+            missing = length - len(buf)
+            if missing <= len(ZEROES):
+                return buf + ZEROES[:missing]
+            return buf + bytes(missing)
 
     async def fsync(self, fh, datasync):
         log.debug('started with %d, %s', fh, datasync)
@@ -1164,6 +1249,7 @@ class Operations(pyfuse3.Operations):
                 del self.open_inodes[id_]
                 if id_ in self.broken_blocks:
                     del self.broken_blocks[id_]
+                self.read_state.pop(id_, None)
 
                 inode = self.inodes[id_]
                 if inode.refcount == 0:
@@ -175,7 +175,8 @@ class Fsck(object):
             if match:
                 inode = int(match.group(1))
                 blockno = int(match.group(2))
-            elif re.match('^(\\d+)-(\\d+)\\.tmp$', filename):
+            elif (re.match('^(\\d+)-(\\d+)\\.tmp$', filename)
+                  or re.match('^obj-(\\d+)\\.download$', filename)):
                 # Temporary file created when downloading object
                 self.found_errors = True
                 self.log_error("Removing leftover temporary file: " + filename)
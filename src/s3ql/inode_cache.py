@@ -176,8 +176,8 @@ class InodeCache(object):
             return inode
 
     def getattr(self, id_): #@ReservedAssignment
-        attrs = self.db.get_row("SELECT %s FROM inodes WHERE id=? " % ATTRIBUTE_STR,
-                                  (id_,))
+        attrs = self.db.get_first_row("SELECT %s FROM inodes WHERE id=? " % ATTRIBUTE_STR,
+                                        (id_,))
         inode = _Inode(self.generation)
 
         for (i, id_) in enumerate(ATTRIBUTES):
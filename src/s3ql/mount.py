@@ -44,9 +44,7 @@ def install_thread_excepthook():
 
     See http://bugs.python.org/issue1230540.
 
-    Call once from __main__ before creating any threads. If using
-    psyco, call psyco.cannotcompile(threading.Thread.run) since this
-    replaces a new-style class method.
+    Call once from __main__ before creating any threads.
     """
 
     init_old = threading.Thread.__init__
@@ -239,7 +237,7 @@ async def main_async(options, stdout_log_handler):
 
         mark_metadata_dirty(backend, cachepath, param)
 
-        block_cache.init(options.threads)
+        block_cache.init(options.threads, nursery)
 
         nursery.start_soon(metadata_upload_task.run, name='metadata-upload-task')
         cm.callback(metadata_upload_task.stop)
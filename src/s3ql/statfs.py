@@ -15,6 +15,10 @@ import sys
 
 log = logging.getLogger(__name__)
 
+# Layout of the s3qlstat extended attribute, must be kept in sync
+# with fs.Operations.extstat()
+STATS = struct.Struct('QQQQQQQQQQQQ')
+
 def parse_args(args):
     '''Parse command line'''
 
@@ -51,14 +55,14 @@ def main(args=None):
 
     ctrlfile = assert_fs_owner(options.mountpoint, mountpoint=True)
 
-    # Use a decent sized buffer, otherwise the statistics have to be
+    # Use a sufficiently large buffer, otherwise the statistics have to be
     # calculated three(!) times because we need to invoke getxattr
     # three times.
-    buf = pyfuse3.getxattr(ctrlfile, 's3qlstat', size_guess=256)
+    buf = pyfuse3.getxattr(ctrlfile, 's3qlstat', size_guess=STATS.size)
 
     (entries, objects, inodes, fs_size, dedup_size,
      compr_size, db_size, cache_cnt, cache_size, dirty_cnt,
-     dirty_size, removal_cnt) = struct.unpack('QQQQQQQQQQQQ', buf)
+     dirty_size, removal_cnt) = STATS.unpack(buf)
     p_dedup = dedup_size * 100 / fs_size if fs_size else 0
     p_compr_1 = compr_size * 100 / fs_size if fs_size else 0
     p_compr_2 = compr_size * 100 / dedup_size if dedup_size else 0
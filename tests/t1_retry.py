@@ -12,9 +12,12 @@ if __name__ == '__main__':
     import sys
     sys.exit(pytest.main([__file__] + sys.argv[1:]))
 
-from s3ql.backends.common import retry
+from s3ql.backends.common import retry, RecoveryNotifier
 from pytest_checklogs import assert_logs
 import logging
+import pytest
+import threading
+import time
 
 class TemporaryProblem(Exception):
     pass
@@ -57,3 +60,61 @@ def test_logging():
     with assert_logs(r'^Encountered %s \(%s\), retrying ',
                       count=2, level=logging.WARNING):
         inst.do_stuff()
+
+def test_recovery_notifier():
+    notifier = RecoveryNotifier()
+    t = threading.Thread(target=notifier.wait, args=(30,))
+    t.start()
+    while not notifier.waiters:
+        time.sleep(0.01)
+    notifier.notify()
+    t.join(5)
+    assert not t.is_alive()
+
+class FailOnce:
+    def __init__(self, exc):
+        self.exc = exc
+        self.count = 0
+
+    @staticmethod
+    def is_temp_failure(exc):
+        return isinstance(exc, (TemporaryProblem, ConnectionError))
+
+    def do_stuff(self):
+        self.count += 1
+        if self.count == 1 and self.exc is not None:
+            raise self.exc
+        return True
+
+@pytest.fixture
+def notifier(monkeypatch):
+    # Make the first retry interval 30 seconds
+    monkeypatch.setattr('s3ql.backends.common.random.uniform', lambda a, b: 1500)
+    return RecoveryNotifier()
+
+def test_retry_wake_early(notifier):
+    inst = FailOnce(ConnectionResetError())
+    do_stuff = retry(FailOnce.do_stuff, _recovery=notifier)
+    t = threading.Thread(target=do_stuff, args=(inst,))
+    t.start()
+    while not notifier.waiters:
+        time.sleep(0.01)
+
+    # A successful request on a different instance should trigger the retry
+    retry(FailOnce.do_stuff, _recovery=notifier)(FailOnce(None))
+    t.join(5)
+    assert not t.is_alive()
+    assert inst.count == 2
+
+def test_retry_no_wake_early(notifier, monkeypatch):
+    # Server errors must not be retried early
+    def wait(timeout):
+        pytest.fail('Retry waits for recovery')
+    monkeypatch.setattr(notifier, 'wait', wait)
+    sleeps = []
+    monkeypatch.setattr('s3ql.backends.common.time.sleep', sleeps.append)
+
+    inst = FailOnce(TemporaryProblem())
+    assert retry(FailOnce.do_stuff, _recovery=notifier)(inst)
+    assert inst.count == 2
+    assert sleeps == [ 30 ]
@@ -19,7 +19,8 @@ from pytest_checklogs import assert_logs
 from s3ql.backends import local
 from s3ql.backends.common import AbstractBackend
 from s3ql.backends.pool import BackendPool
-from s3ql.block_cache import BlockCache, QuitSentinel
+from s3ql.block_cache import (BlockCache, QuitSentinel, HOT_HITS, HOT_INTERVAL,
+                              HOT_DECAY)
 from s3ql.common import time_ns
 from s3ql.database import Connection
 from s3ql.metadata import create_tables
@@ -34,6 +35,7 @@ import shutil
 import stat
 import tempfile
 import threading
+import time
 import trio
 
 log = logging.getLogger(__name__)
@@ -202,6 +204,92 @@ async def test_get(ctx):
         fh.seek(0)
         assert data == fh.read(len(data))
 
+async def test_prefetch(ctx):
+    inode = ctx.inode
+    data = random_data(int(0.5 * ctx.max_obj_size))
+
+    # Use different data, otherwise the blocks share one object
+    for blockno in (1, 2):
+        async with ctx.cache.get(inode, blockno) as fh:
+            fh.write(data + bytes([blockno]))
+    await ctx.cache.drop()
+
+    # Block 3 does not exist and must not be created
+    ctx.cache.backend_pool = MockBackendPool(ctx.backend_pool, no_read=2)
+    async with trio.open_nursery() as nursery:
+        ctx.cache.prefetch_nursery = nursery
+        ctx.cache.prefetch(inode, range(1, 4))
+    ctx.cache.prefetch_nursery = None
+    ctx.cache.backend_pool.verify()
+    assert (inode, 1) in ctx.cache.cache
+    assert (inode, 2) in ctx.cache.cache
+    assert (inode, 3) not in ctx.cache.cache
+    assert not ctx.cache.prefetching
+
+    # Cached blocks are not downloaded again
+    ctx.cache.backend_pool = MockBackendPool(ctx.backend_pool)
+    async with ctx.cache.get(inode, 1) as fh:
+        fh.seek(0)
+        assert data + b'\x01' == fh.read(len(data) + 1)
+    ctx.cache.backend_pool.verify()
+
+@pytest.mark.trio
+async def test_prefetch_error(ctx):
+    inode = ctx.inode
+    async with ctx.cache.get(inode, 1) as fh:
+        fh.write(b'foobar')
+    await ctx.cache.drop()
+
+    # Failed prefetches must not propagate
+    ctx.cache.backend_pool = MockBackendPool(ctx.backend_pool, no_read=0)
+    async with trio.open_nursery() as nursery:
+        ctx.cache.prefetch_nursery = nursery
+        ctx.cache.prefetch(inode, (1,))
+    ctx.cache.prefetch_nursery = None
+    assert (inode, 1) not in ctx.cache.cache
+    assert not ctx.cache.prefetching
+    assert not ctx.cache.mlock.locked_keys
+    assert not os.listdir(ctx.cache.path)
+
+    ctx.cache.backend_pool = ctx.backend_pool
+    async with ctx.cache.get(inode, 1) as fh:
+        fh.seek(0)
+        assert fh.read() == b'foobar'
+
+async def test_download_shared(ctx):
+    inode = ctx.inode
+    data = random_data(int(0.5 * ctx.max_obj_size))
+
+    # All blocks refer to the same object
+    for blockno in (1, 2, 3):
+        async with ctx.cache.get(inode, blockno) as fh:
+            fh.write(data)
+    await ctx.cache.drop()
+    assert ctx.db.get_val('SELECT COUNT(*) FROM objects') == 1
+
+    # Concurrent downloads must share one request
+    ctx.cache.backend_pool = MockBackendPool(ctx.backend_pool, no_read=1)
+    read = dict()
+    async def read_block(blockno):
+        async with ctx.cache.get(inode, blockno) as fh:
+            fh.seek(0)
+            read[blockno] = fh.read(len(data) + 1)
+    async with trio.open_nursery() as nursery:
+        for blockno in (1, 2, 3):
+            nursery.start_soon(read_block, blockno)
+    ctx.cache.backend_pool.verify()
+    assert read == { 1: data, 2: data, 3: data }
+    assert not ctx.cache.downloads
+    assert sorted(os.listdir(ctx.cache.path)) == [ '%d-%d' % (inode, x) for x in (1, 2, 3) ]
+
+    # Blocks are independent copies
+    async with ctx.cache.get(inode, 1) as fh:
+        fh.seek(0)
+        fh.write(b'foobar')
+    async with ctx.cache.get(inode, 2) as fh:
+        fh.seek(0)
+        assert data == fh.read(len(data) + 1)
+
 @pytest.mark.trio
 async def test_expire(ctx):
     inode = ctx.inode
@@ -237,6 +325,88 @@ async def test_expire(ctx):
         else:
             assert (inode, i) in ctx.cache.cache
 
+async def test_expire_hot(ctx):
+    inode = ctx.inode
+
+    for i in range(10):
+        async with ctx.cache.get(inode, i) as fh:
+            fh.write(('%d' % i).encode())
+
+    # Accesses in quick succession (e.g. reading a block in chunks) are
+    # counted only once
+    for i in range(5):
+        async with ctx.cache.get(inode, 0):
+            pass
+    assert ctx.cache.cache[(inode, 0)].hits == 0
+
+    # Make block 0 hot
+    for i in range(HOT_HITS):
+        ctx.cache.cache[(inode, 0)].last_hit -= HOT_INTERVAL
+        async with ctx.cache.get(inode, 0):
+            pass
+    assert ctx.cache.cache[(inode, 0)].hits == HOT_HITS
+
+    # Make block 0 less recently used than most others
+    for i in range(1, 10):
+        async with ctx.cache.get(inode, i):
+            pass
+
+    ctx.cache.cache.max_entries = 5
+    await ctx.cache.expire()
+    assert len(ctx.cache.cache) == 5
+    assert (inode, 0) in ctx.cache.cache
+    for i in range(1, 6):
+        assert (inode, i) not in ctx.cache.cache
+    for i in range(6, 10):
+        assert (inode, i) in ctx.cache.cache
+
+    # Hot entries are expired if there is no other choice
+    ctx.cache.cache.max_entries = 0
+    await ctx.cache.expire()
+    assert len(ctx.cache.cache) == 0
+
+async def test_expire_hot_order(ctx):
+    inode = ctx.inode
+
+    for i in range(10):
+        async with ctx.cache.get(inode, i) as fh:
+            fh.write(('%d' % i).encode())
+
+    # Blocks 0 to 2 are hot, block 0 is used least recently
+    for i in range(3):
+        ctx.cache.cache[(inode, i)].hits = HOT_HITS
+
+    # Only one entry can be protected, this must be the most recently
+    # used one
+    ctx.cache.cache.max_entries = 5
+    await ctx.cache.expire()
+    assert sorted(ctx.cache.cache) == [ (inode, i) for i in (2, 6, 7, 8, 9) ]
+
+async def test_expire_hot_decay(ctx):
+    inode = ctx.inode
+
+    for i in range(10):
+        async with ctx.cache.get(inode, i) as fh:
+            fh.write(('%d' % i).encode())
+
+    # Block 0 used to be hot, but hasn't been accessed for a while
+    el = ctx.cache.cache[(inode, 0)]
+    el.hits = HOT_HITS
+    el.last_hit -= HOT_DECAY
+    assert el.get_hits(time.monotonic()) == HOT_HITS - 1
+
+    ctx.cache.cache.max_entries = 5
+    await ctx.cache.expire()
+    assert (inode, 0) not in ctx.cache.cache
+
+    # Hits are decayed before counting a new one
+    el = ctx.cache.cache[(inode, 9)]
+    el.hits = HOT_HITS
+    el.last_hit -= 2 * HOT_DECAY
+    async with ctx.cache.get(inode, 9):
+        pass
+    assert el.hits == HOT_HITS - 1
+
 async def test_upload(ctx):
     inode = ctx.inode
     datalen = int(0.1 * ctx.cache.cache.max_size)
@@ -456,6 +626,25 @@ async def test_remove_db(ctx):
         fh.seek(0)
         assert fh.read(42) ==  b''
 
+async def test_remove_sparse(ctx):
+    inode = ctx.inode
+    data = random_data(int(0.4 * ctx.max_obj_size))
+
+    # One block only in DB, one only in cache
+    async with ctx.cache.get(inode, 3) as fh:
+        fh.write(data)
+    await ctx.cache.drop()
+    async with ctx.cache.get(inode, 2**40) as fh:
+        fh.write(data)
+
+    # Must not iterate over every block in the range
+    ctx.cache.backend_pool = MockBackendPool(ctx.backend_pool, no_del=1)
+    with trio.fail_after(5):
+        await ctx.cache.remove(inode, 0, 2**41)
+    ctx.cache.backend_pool.verify()
+    assert len(ctx.cache.cache) == 0
+    assert not ctx.db.has_val('SELECT 1 FROM inode_blocks WHERE inode=?', (inode,))
+
 
 class MockMultiLock:
     def __init__(self, real_mlock):
@@ -37,6 +37,7 @@ import os
 import pytest
 import shutil
 import stat
+import struct
 import tempfile
 import trio
 
@@ -999,6 +1000,50 @@ async def test_copy_tree_2(ctx, monkeypatch):
     await ctx.server.forget([(src_inode.st_ino, 1), (dst_inode.st_ino, 1)])
     await fsck(ctx)
 
+async def check_stats(ctx):
+    (_, objects, inodes, _, dedup_size) = struct.unpack('QQQQQQQQQQQQ',
+                                                        ctx.server.extstat())[:5]
+    assert objects == ctx.db.get_val('SELECT COUNT(id) FROM objects')
+    assert inodes == ctx.db.get_val('SELECT COUNT(id) FROM inodes')
+    assert dedup_size == ctx.db.get_val('SELECT IFNULL(SUM(length), 0) FROM objects')
+
+    stat_ = await ctx.server.statfs(some_ctx)
+    assert stat_.f_files - stat_.f_ffree == inodes
+
+async def test_copy_tree_stats(ctx, monkeypatch):
+    src_inode = await ctx.server.mkdir(ROOT_INODE, b'source', dir_mode(), some_ctx)
+    dst_inode = await ctx.server.mkdir(ROOT_INODE, b'dest', dir_mode(), some_ctx)
+
+    (fi, inode) = await ctx.server.create(src_inode.st_ino, b'file1',
+                                 file_mode(), os.O_RDWR, some_ctx)
+    fh = fi.fh
+    await ctx.server.write(fh, 0, b'block 1 contents')
+    # Several blocks sharing one object
+    for blockno in (1, 2, 3):
+        await ctx.server.write(fh, blockno * ctx.max_obj_size, b'block 2 contents')
+    await ctx.server.release(fh)
+    await ctx.server.forget([(inode.st_ino, 1)])
+    await ctx.cache.drop()
+    await check_stats(ctx)
+    assert sorted(ctx.db.get_list('SELECT refcount FROM objects')) == [ (1,), (3,) ]
+
+    monkeypatch.setattr('pyfuse3.invalidate_inode', lambda *args: None)
+    await ctx.server.copy_tree(src_inode.st_ino, dst_inode.st_ino)
+    await check_stats(ctx)
+    assert sorted(ctx.db.get_list('SELECT refcount FROM objects')) == [ (2,), (6,) ]
+
+    # Objects are still referenced by the copy
+    await ctx.server.unlink(src_inode.st_ino, b'file1', some_ctx)
+    await check_stats(ctx)
+    assert ctx.db.get_val('SELECT COUNT(id) FROM objects') == 2
+
+    await ctx.server.unlink(dst_inode.st_ino, b'file1', some_ctx)
+    await check_stats(ctx)
+    assert ctx.db.get_val('SELECT COUNT(id) FROM objects') == 0
+
+    await ctx.server.forget([(src_inode.st_ino, 1), (dst_inode.st_ino, 1)])
+    await fsck(ctx)
+
 async def test_lock_tree(ctx):
 
     inode1 = await ctx.server.mkdir(ROOT_INODE, b'source', dir_mode(), some_ctx)
@@ -103,6 +103,13 @@ class fsck_tests(unittest.TestCase):
             fh.write(b'somedat3')
         self.assert_fsck(self.fsck.check_cache)
 
+    def test_cache_tmpfiles(self):
+        for name in ('42-1.tmp', 'obj-7.download'):
+            with open(os.path.join(self.cachedir, name), 'wb') as fh:
+                fh.write(b'partial data')
+        self.assert_fsck(self.fsck.check_cache)
+        assert not os.listdir(self.cachedir)
+
 
     def test_lof1(self):
 